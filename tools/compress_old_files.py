@@ -1,5 +1,6 @@
 import argparse
 import datetime
+import itertools
 import logging
 import os
 import pathlib
@@ -7,9 +8,10 @@ import re
 import shutil
 import stat
 import zipfile
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
 from setuptools.archive_util import _unpack_zipfile_obj
 
@@ -25,6 +27,11 @@ _log.setLevel(logging.DEBUG)
 
 
 FolderDate = namedtuple("FolderDate", ["year", "month"])
+_FOLDER_RE = re.compile("(?P<year>[0-9]{4})-(?P<month>[0-9]{1,2})")
+_READ_AHEAD_BYTES = 16 * 1024 * 1024
+_READ_CHUNK_BYTES = 1024 * 1024
+_STORE_BELOW_BYTES = 64 * 1024
+_SCAN_THREADS = 16
 
 
 @dataclass
@@ -59,6 +66,20 @@ def remove_readonly(func, path, excinfo_ignored):
     func(path)
 
 
+def _remove_archived(file_paths: List[str], dir_paths: List[str]):
+    """deletes the archived paths, dir_paths in walk order so children go first"""
+    for path in file_paths:
+        try:
+            os.unlink(path)
+        except PermissionError:
+            remove_readonly(os.unlink, path, None)
+    for path in reversed(dir_paths):
+        try:
+            os.rmdir(path)
+        except PermissionError:
+            remove_readonly(os.rmdir, path, None)
+
+
 def sizeof_fmt(num: Union[int, float], suffix="B") -> str:
     for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
         if abs(num) < 1024.0:
@@ -67,6 +88,16 @@ def sizeof_fmt(num: Union[int, float], suffix="B") -> str:
     return f"{num:.1f}Yi{suffix}"
 
 
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a whole number: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def get_parsed_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("--basedir", help="basedir for search", required=True)
@@ -75,6 +106,12 @@ def get_parsed_args() -> argparse.Namespace:
         help="compress from month folders that are this many months old.",
         type=int,
     )
+    parser.add_argument(
+        "--jobs",
+        help="number of archives that are written in parallel. "
+        "defaults to the number of CPUs.",
+        type=_positive_int,
+    )
     return parser.parse_args()
 
 
@@ -86,6 +123,7 @@ def _get_old_monthly_folders(
     if not basedir.exists():
         _log.error(f"basedir is not a dir {basedir}")
     else:
+        now = datetime.datetime.now()
         for item in basedir.iterdir():
             if not item.is_dir():
                 continue
@@ -94,10 +132,7 @@ def _get_old_monthly_folders(
                 if not date:
                     continue
                 age_in_months = month_difference(
-                    datetime.datetime.now().year,
-                    datetime.datetime.now().month,
-                    date.year,
-                    date.month,
+                    now.year, now.month, date.year, date.month
                 )
                 if age_in_months >= min_age_months:
                     _log.info(f"found candidate: {str(item)}")
@@ -122,103 +157,264 @@ def month_difference(year_a: int, month_a: int, year_b: int, month_b: int) -> in
 
 
 def _get_date_from_path(path: pathlib.Path) -> Union[FolderDate, None]:
-    folder_pattern = "(?P<year>[0-9]{4})-(?P<month>[0-9]{1,2})"
-    match = re.match(folder_pattern, str(path.stem))
+    match = _FOLDER_RE.match(path.name)
 
     retval = None
     if match:
-        retval = FolderDate(
-            year=int(match.groupdict().get("year")),
-            month=int(match.groupdict().get("month")),
-        )
+        retval = FolderDate(year=int(match["year"]), month=int(match["month"]))
     return retval
 
 
-def discover_old_input_directories(
-    basedir: pathlib.Path, min_age_months=2
-) -> list[pathlib.Path]:
-    old_month_folder = _get_old_monthly_folders(
-        basedir=basedir, min_age_months=min_age_months
-    )
-    old_input_folders = []
-    for month_folder in old_month_folder:
-        for project_candidate in month_folder.iterdir():
-            if not project_candidate.is_dir():
+def _scan_month(month_folder: pathlib.Path) -> List[pathlib.Path]:
+    input_folders = []
+    with os.scandir(month_folder) as projects:
+        for project_candidate in projects:
+            if not project_candidate.is_dir(follow_symlinks=False):
                 continue
-            for input_folder_candidate in project_candidate.iterdir():
-                if input_folder_candidate.is_dir() and str(
-                    input_folder_candidate.stem
-                ).startswith("input"):
-                    old_input_folders.append(input_folder_candidate)
-    return old_input_folders
+            with os.scandir(project_candidate.path) as candidates:
+                for input_folder_candidate in candidates:
+                    if input_folder_candidate.is_dir(
+                        follow_symlinks=False
+                    ) and input_folder_candidate.name.startswith("input"):
+                        input_folders.append(pathlib.Path(input_folder_candidate.path))
+    return input_folders
 
 
-def get_folder_size(folder: pathlib.Path) -> int:
-    size = sum(f.stat().st_size for f in folder.glob("**/*") if f.is_file())
-    return size
+def _find_input_directories(
+    old_month_folders: List[pathlib.Path],
+) -> List[pathlib.Path]:
+    # listing directories mostly waits on the file system (e.g. a network share),
+    # so the month folders are scanned concurrently
+    with ThreadPoolExecutor(max_workers=_SCAN_THREADS) as executor:
+        per_month = list(executor.map(_scan_month, old_month_folders))
+    return list(itertools.chain.from_iterable(per_month))
+
+
+def _walk_for_archive(path: str, arc_prefix: str = ""):
+    """yields (path, arcname, size, is_dir) for every entry below path"""
+    with os.scandir(path) as it:
+        for entry in it:
+            arcname = arc_prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.path, f"{arcname}/", 0, True
+                yield from _walk_for_archive(entry.path, f"{arcname}/")
+            elif entry.is_symlink() and entry.is_dir():
+                # stored as an empty directory like make_archive did, not followed
+                yield entry.path, f"{arcname}/", 0, False
+            elif entry.is_file():
+                yield entry.path, arcname, entry.stat().st_size, False
+            else:
+                raise RuntimeError(
+                    f"cannot archive {entry.path}: unsupported file type"
+                )
 
 
-def _check_archive_for_errors(a: pathlib.Path):
+def _check_archive_for_errors(a: str, expected_sizes: Dict[str, int]):
+    """checks that every expected member is listed with its size in the archive"""
     with zipfile.ZipFile(a) as arch:
-        archive_check_has_error = arch.testzip()
-        if archive_check_has_error:
-            raise RuntimeError(f"bad zipfile {a}")
-        else:
-            _log.debug(f"success: {str(a)}")
-
-
-def compress_and_delete_folder(input_list: List[pathlib.Path]) -> CompressionStats:
-    size_uncompressed, size_compressed = 0.0, 0.0
-    for item in input_list:
-        archive_path = shutil.make_archive(
-            str(item), format="zip", root_dir=str(item), logger=_log
-        )
-        _check_archive_for_errors(archive_path)
-
-        item_uncompressed = get_folder_size(item)
-        item_compressed = pathlib.Path(archive_path).stat().st_size
-        _log.debug(
-            f"uncompressed: {sizeof_fmt(item_uncompressed)}, compressed: {sizeof_fmt(item_compressed)}"
-        )
-        size_uncompressed += item_uncompressed
-        size_compressed += item_compressed
-        shutil.rmtree(str(item), onerror=remove_readonly)
+        sizes_in_archive = {info.filename: info.file_size for info in arch.infolist()}
+    for name, size in expected_sizes.items():
+        if sizes_in_archive.get(name) != size:
+            raise RuntimeError(f"bad zipfile {a}: member {name} missing or truncated")
+    _log.debug(f"success: {str(a)}")
+
+
+def _compress_one(item: pathlib.Path) -> CompressionStats:
+    item_path = os.fspath(item)
+    archive_path = f"{item_path}.zip"
+    if os.path.lexists(archive_path):
+        # never replace an archive, it may hold files that are gone from item
+        _log.warning(f"archive already exists, skipping: {archive_path}")
+        return CompressionStats()
+
+    item_uncompressed = 0
+    written = {}
+    file_paths, dir_paths = [], [item_path]
+    # "x" fails instead of truncating an archive that appeared in the meantime
+    arch = zipfile.ZipFile(archive_path, "x", compression=zipfile.ZIP_DEFLATED)
+    try:
+        with arch:
+            for path, arcname, size, is_dir in _walk_for_archive(item_path):
+                item_uncompressed += size
+                arch.write(path, arcname=arcname)
+                written[arcname] = size
+                if is_dir:
+                    dir_paths.append(path)
+                else:
+                    file_paths.append(path)
+        _check_archive_for_errors(archive_path, written)
+    except (OSError, RuntimeError) as e:
+        # e.g. a fifo or broken link, only this folder is left for the user to fix
+        _log.error(f"not archived, {item_path} is kept: {e}")
+        os.unlink(archive_path)
+        return CompressionStats()
+    except BaseException:
+        # do not leave a bad archive behind that blocks the next run
+        os.unlink(archive_path)
+        raise
+
+    item_compressed = os.stat(archive_path).st_size
+    _log.debug(
+        f"uncompressed: {sizeof_fmt(item_uncompressed)}, compressed: {sizeof_fmt(item_compressed)}"
+    )
+    _remove_archived(file_paths, dir_paths)
 
     return CompressionStats(
-        uncompressed=size_uncompressed,
-        compressed=size_compressed,
-        count=len(input_list) if input_list else 0,
+        uncompressed=item_uncompressed, compressed=item_compressed, count=1
     )
 
 
-def compress_input_folders(basedir: pathlib.Path, min_age_months=2) -> CompressionStats:
-    input_dirs_to_compress = discover_old_input_directories(basedir)
-    stats = compress_and_delete_folder(input_dirs_to_compress)
+def compress_and_delete_folder(
+    input_list: List[pathlib.Path], jobs: Union[int, None] = None
+) -> CompressionStats:
+    # every folder goes into its own archive, so they can be deflated in parallel
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_compress_one, input_list))
+    return sum(results, CompressionStats())
+
+
+def compress_input_folders(
+    old_month_folders: List[pathlib.Path], jobs: Union[int, None] = None
+) -> CompressionStats:
+    input_dirs_to_compress = _find_input_directories(old_month_folders)
+    stats = compress_and_delete_folder(input_dirs_to_compress, jobs=jobs)
     return stats
 
 
+def _read_chunk(opened: Future, path: str, length: int) -> bytes:
+    chunk = opened.result().read(length)
+    if len(chunk) != length:
+        raise RuntimeError(f"{path} changed while it was archived")
+    return chunk
+
+
+def _close(opened: Future):
+    opened.result().close()
+
+
+def _read_ahead(
+    files: Iterable[Tuple[str, int]], max_buffered=_READ_AHEAD_BYTES
+) -> Iterator[Tuple[str, bytes]]:
+    """yields (path, chunk) for all files in order, read ahead by a background thread"""
+    pending = deque()
+    buffered = 0
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        for path, size in files:
+            # the single reader runs its tasks in order: every file is opened
+            # once, read chunk by chunk and closed after its last chunk
+            opened = reader.submit(open, path, "rb")
+            try:
+                for offset in range(0, size, _READ_CHUNK_BYTES):
+                    length = min(_READ_CHUNK_BYTES, size - offset)
+                    while pending and buffered + length > max_buffered:
+                        done_path, done_length, chunk = pending.popleft()
+                        buffered -= done_length
+                        yield done_path, chunk.result()
+                    chunk = reader.submit(_read_chunk, opened, path, length)
+                    pending.append((path, length, chunk))
+                    buffered += length
+            finally:
+                reader.submit(_close, opened)
+        while pending:
+            done_path, _, chunk = pending.popleft()
+            yield done_path, chunk.result()
+
+
+def _write_gcode_members(arch: zipfile.ZipFile, files_to_write: List[Tuple[str, int]]):
+    # a few kilobytes are not worth the compressor, store them as they are
+    bytes_to_write = sum(size for _, size in files_to_write)
+    if bytes_to_write < _STORE_BELOW_BYTES:
+        compress_type = zipfile.ZIP_STORED
+    else:
+        compress_type = arch.compression
+    chunks = _read_ahead(files_to_write)
+    for g_file, size in files_to_write:
+        zinfo = zipfile.ZipInfo.from_file(g_file, arcname=os.path.basename(g_file))
+        zinfo.compress_type = compress_type
+        # ZipFile.open takes no compresslevel, ZipFile.write copies the archive's
+        # level into the ZipInfo the same way. the field is public since python
+        # 3.13, before that (3.7 to 3.12) it only exists as _compresslevel
+        if hasattr(zinfo, "compress_level"):
+            zinfo.compress_level = arch.compresslevel
+        else:
+            zinfo._compresslevel = arch.compresslevel
+        # stream the chunks into the member, a file is never held in memory
+        with arch.open(zinfo, "w") as member:
+            remaining = size
+            while remaining:
+                _, chunk = next(chunks)
+                member.write(chunk)
+                remaining -= len(chunk)
+
+
 def _archive_and_delete_gcode_in_dir(
-    input_folder: pathlib.Path, archive_name
+    input_folder: pathlib.Path, archive_name: str
 ) -> CompressionStats:
-    all_gcode_files = list(input_folder.glob("*.gcode"))
-    all_gcode_sizes = [f.stat().st_size for f in all_gcode_files if f.is_file()]
-
-    if all_gcode_files:
-        with zipfile.ZipFile(archive_name, "a", compression=zipfile.ZIP_LZMA) as arch:
-            files_in_archive = [x.filename for x in arch.filelist]
-            for g_file in all_gcode_files:
-                if g_file.name in files_in_archive:
-                    _log.debug(f"file already present: {g_file.name}")
-                    continue
-                arch.write(g_file, arcname=g_file.name)
-        _check_archive_for_errors(archive_name)
+    all_gcode_sizes = {}
+    with os.scandir(input_folder) as it:
+        for entry in it:
+            # normcase keeps the case-insensitive match that glob had on windows
+            if os.path.normcase(entry.name).endswith(".gcode") and entry.is_file():
+                all_gcode_sizes[entry.path] = entry.stat().st_size
+
+    if all_gcode_sizes:
+        archive_exists = os.path.exists(archive_name)
+        files_in_archive = []
+        if archive_exists:
+            with zipfile.ZipFile(archive_name) as arch:
+                files_in_archive = [x.filename for x in arch.filelist]
+        # every gcode file is checked against the archive before it is deleted,
+        # also those already present, a copy that differs keeps the file
+        expected = {}
+        files_to_write = []
+        for g_file, size in all_gcode_sizes.items():
+            g_name = os.path.basename(g_file)
+            expected[g_name] = size
+            if g_name in files_in_archive:
+                _log.debug(f"file already present: {g_name}")
+                continue
+            files_to_write.append((g_file, size))
+
+        if files_to_write:
+            # a member that fails half-way would still be committed by zipfile,
+            # so new members go into a copy that only replaces the archive once
+            # every member checks out
+            tmp_archive = f"{archive_name}.tmp"
+            if archive_exists:
+                shutil.copyfile(archive_name, tmp_archive)
+            try:
+                with zipfile.ZipFile(
+                    tmp_archive,
+                    "a" if archive_exists else "w",
+                    compression=zipfile.ZIP_DEFLATED,
+                    compresslevel=9,
+                ) as arch:
+                    _write_gcode_members(arch, files_to_write)
+                _check_archive_for_errors(tmp_archive, expected)
+            except (OSError, RuntimeError) as e:
+                # only this project is left for the user to fix
+                _log.error(f"gcode files not archived, {input_folder} is kept: {e}")
+                os.unlink(tmp_archive)
+                return CompressionStats()
+            except BaseException:
+                os.unlink(tmp_archive)
+                raise
+            os.replace(tmp_archive, archive_name)
+        else:
+            try:
+                _check_archive_for_errors(archive_name, expected)
+            except RuntimeError as e:
+                _log.error(f"gcode files not deleted, {input_folder} is kept: {e}")
+                return CompressionStats()
+
         s = CompressionStats(
-            uncompressed=sum(all_gcode_sizes),
-            compressed=archive_name.stat().st_size,
-            count=len(all_gcode_files),
+            uncompressed=sum(all_gcode_sizes.values()),
+            compressed=os.stat(archive_name).st_size,
+            count=len(all_gcode_sizes),
         )
-        for g_file in all_gcode_files:
-            os.remove(g_file)
+        # delete only once the archive is verified, then in one batch
+        for g_file in all_gcode_sizes:
+            os.unlink(g_file)
     else:  # no gcode file found
         s = CompressionStats()
 
@@ -226,20 +422,35 @@ def _archive_and_delete_gcode_in_dir(
 
 
 def compress_and_delete_gcode_files(
-    basedir: pathlib.Path, min_age_months=2
+    old_month_folders: List[pathlib.Path], jobs: Union[int, None] = None
 ) -> CompressionStats:
-    old_month_folders = _get_old_monthly_folders(basedir, min_age_months=min_age_months)
-    compression_stats = []
+    project_folders, archive_names = [], []
     for month_item in old_month_folders:
-        for project__candidate in month_item.iterdir():
-            if not project__candidate.is_dir():
-                continue
-            archive_name = project__candidate.joinpath(
-                f"{project__candidate.stem}-gcodearchive.zip"
-            )
-            c_stat = _archive_and_delete_gcode_in_dir(project__candidate, archive_name)
-            compression_stats.append(c_stat)
-    return sum(compression_stats)
+        with os.scandir(month_item) as projects:
+            for project__candidate in projects:
+                # symlinked projects are skipped, like in the input folder scan
+                if not project__candidate.is_dir(follow_symlinks=False):
+                    continue
+                project_path = project__candidate.path
+                project_folders.append(pathlib.Path(project_path))
+                stem = os.path.splitext(project__candidate.name)[0]
+                archive_names.append(
+                    os.path.join(project_path, f"{stem}-gcodearchive.zip")
+                )
+    # one archive per project, so the compressor runs on several cores at once
+    total_uncompressed, total_compressed, total_count = 0.0, 0.0, 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for c_stat in executor.map(
+            _archive_and_delete_gcode_in_dir, project_folders, archive_names
+        ):
+            total_uncompressed += c_stat.uncompressed
+            total_compressed += c_stat.compressed
+            total_count += c_stat.count
+    return CompressionStats(
+        uncompressed=total_uncompressed,
+        compressed=total_compressed,
+        count=total_count,
+    )
 
 
 def run_main(args: argparse.Namespace):
@@ -247,9 +458,11 @@ def run_main(args: argparse.Namespace):
 
     min_age_months = int(args.min_age) if args.min_age else 2
 
-    stats_input_dirs = compress_input_folders(basedir, min_age_months=min_age_months)
+    # both passes work on the same month folders, so basedir is only scanned once
+    old_month_folders = _get_old_monthly_folders(basedir, min_age_months=min_age_months)
+    stats_input_dirs = compress_input_folders(old_month_folders, jobs=args.jobs)
     stats_gcode_files = compress_and_delete_gcode_files(
-        basedir, min_age_months=min_age_months
+        old_month_folders, jobs=args.jobs
     )
 
     stats = stats_input_dirs + stats_gcode_files